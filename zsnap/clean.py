@@ -25,7 +25,7 @@ Provides functionality for cleaning up old ZFS snapshots
 
 import re
 import time
-from datetime import datetime
+from bisect import bisect_left
 from collections import OrderedDict
 
 from magcode.core.globals_ import log_info
@@ -36,6 +36,9 @@ from zsnap.zfs import ZFS
 from zsnap.globals_ import CLEANER_REGEX
 from zsnap.globals_ import SNAPSHOTNAME_REGEX
 
+_CLEANER_RE = re.compile(CLEANER_REGEX)
+_SNAPNAME_RE = re.compile(SNAPSHOTNAME_REGEX)
+
 class Cleaner(object):
     """
     Cleaner class, containing all methods for cleaning up ZFS snapshots
@@ -50,7 +53,7 @@ class Cleaner(object):
         midnight = time.mktime(time.strptime('{0}-{1}-{2}'.format(now.tm_year, now.tm_mon, now.tm_mday) , '%Y-%m-%d'))
 
         # Parsing schema
-        match = re.match(CLEANER_REGEX, schema)
+        match = _CLEANER_RE.match(schema)
         if not match:
             log_info('[{0}] - Got invalid schema for dataset {0}: {1}'.format(local_dataset, dataset, schema))
             return
@@ -61,106 +64,105 @@ class Cleaner(object):
         settings['keep'] = settings.get('keep', 0) 
         base_time = midnight - settings['keep']*86400
 
-        # Loading snapshots
-        snapshot_list = []
+        # Loading snapshots, as parallel lists indexed by snapshot
+        names = []
+        handles = []
+        ages = []
         for snapshot in snapshots:
             snapshotname = snapshots[snapshot]['name']
-            if (not all_snapshots and re.match(SNAPSHOTNAME_REGEX, snapshotname) is None):
+            if (not all_snapshots and _SNAPNAME_RE.match(snapshotname) is None):
                 # If required, only clean zsnapd snapshots
                 continue
-            held = False
-            if ZFS.is_held(dataset, snapshotname, endpoint, log_command=log_command):
-                log_debug('[{0}]   - Keeping {1}@{2} - held snapshot'
-                        .format(local_dataset, dataset, snapshotname))
-                held = True
             snapshot_ctime = snapshots[snapshot]['creation']
             snapshot_age = (base_time - snapshot_ctime)/3600
             snapshot_age = int(snapshot_age) if snapshot_age >= 0 else -1
-            snapshot_list.append({'name': snapshotname,
-                                  'handle': snapshot,
-                                  'time': datetime.fromtimestamp(snapshot_ctime),
-                                  'age': snapshot_age,
-                                  'held': held})
+            names.append(snapshotname)
+            handles.append(snapshot)
+            ages.append(snapshot_age)
 
-        buckets = {}
+        # Bucket upper age limits, in hours - built in increasing order
+        bucket_keys = []
         counter = -1
         for i in range(settings['hours']):
             counter += 1
-            buckets[counter] = []
+            bucket_keys.append(counter)
         for i in range(settings['days']):
             counter += (1 * 24)
-            buckets[counter] = []
+            bucket_keys.append(counter)
         for i in range(settings['weeks']):
             counter += (7 * 24)
-            buckets[counter] = []
+            bucket_keys.append(counter)
         for i in range(settings['months']):
             counter += (30 * 24)
-            buckets[counter] = []
+            bucket_keys.append(counter)
         for i in range(settings['years']):
             counter += (30 * 12 * 24)
-            buckets[counter] = []
+            bucket_keys.append(counter)
+        bucket_lists = [[] for key in bucket_keys]
 
         will_delete = False
         end_of_life_snapshots = []
         kept_flag = False
-        for snapshot in snapshot_list:
-            if snapshot['age'] <= 0:
+        for i, age in enumerate(ages):
+            if age <= 0:
                 log_debug('[{0}]   - Ignoring and keeping {1}@{2} - too fresh'
-                        .format(local_dataset, dataset, snapshot['name']))
+                        .format(local_dataset, dataset, names[i]))
                 kept_flag = True
                 continue
-            possible_keys = []
-            for key in buckets:
-                if snapshot['age'] <= key:
-                    possible_keys.append(key)
-            if possible_keys:
-                buckets[min(possible_keys)].append(snapshot)
+            # Smallest bucket the snapshot fits in
+            index = bisect_left(bucket_keys, age)
+            if index < len(bucket_keys):
+                bucket_lists[index].append(i)
             else:
                 will_delete = True
-                end_of_life_snapshots.append(snapshot)
+                end_of_life_snapshots.append(i)
 
         # Return from procedure if no scripts found to keep
         if (return_no_keep and not kept_flag):
             return
 
-        to_delete = {}
-        to_keep = {}
-        for key in buckets:
+        to_delete = []
+        for bucket in bucket_lists:
             oldest = None
-            if len(buckets[key]) == 1:
-                oldest = buckets[key][0]
-            else:
-                for snapshot in buckets[key]:
-                    if oldest is None:
-                        oldest = snapshot
-                    elif snapshot['age'] > oldest['age']:
-                        oldest = snapshot
-                    else:
-                        will_delete = True
-                        to_delete[key] = to_delete.get(key, []) + [snapshot]
-            to_keep[key] = oldest
-            to_delete[key] = to_delete.get(key, [])
-
-        if will_delete is True:
-            log_info('[{0}] - Cleaning {1}'.format(local_dataset, dataset))
-
-        keys = list(to_delete.keys())
-        keys.sort()
-        for key in keys:
-            for snapshot in to_delete[key]:
-                if snapshot['held']:
-                    log_info('[{0}] -   Skipping held {1}@{2}'.format(local_dataset, dataset, snapshot['name']))
-                    continue
-                log_info('[{0}] -   Destroying {1}@{2}'.format(local_dataset, dataset, snapshot['name']))
-                ZFS.destroy(dataset, snapshot['name'], endpoint, log_command=log_command)
-                snapshots.pop(snapshot['handle'])
-        for snapshot in end_of_life_snapshots:
-            if snapshot['held']:
-                log_info('[{0}] -   Skipping held {1}@{2}'.format(local_dataset, dataset, snapshot['name']))
+            for i in bucket:
+                if oldest is None:
+                    oldest = i
+                elif ages[i] > ages[oldest]:
+                    oldest = i
+                else:
+                    will_delete = True
+                    to_delete.append(i)
+
+        # Nothing to destroy, so no need to look up holds
+        if will_delete is not True:
+            return
+        log_info('[{0}] - Cleaning {1}'.format(local_dataset, dataset))
+
+        # Holds for all the snapshots, listed in one go
+        held_snapshots = set(ZFS.holds(dataset, endpoint, log_command=log_command))
+        destroy_list = []
+        held_names = []
+        for i in to_delete + end_of_life_snapshots:
+            if names[i] in held_snapshots:
+                held_names.append(names[i])
                 continue
-            log_info('[{0}] -   Destroying {1}@{2}'.format(local_dataset, dataset, snapshot['name']))
-            ZFS.destroy(dataset, snapshot['name'], endpoint, log_command=log_command)
-            snapshots.pop(snapshot['handle'])
-
-        if will_delete is True:
-            log_info('[{0}] - Cleaning {1} complete'.format(local_dataset, dataset))
+            log_info('[{0}] -   Destroying {1}@{2}'.format(local_dataset, dataset, names[i]))
+            destroy_list.append(i)
+        if held_names:
+            log_info('[{0}] -   Skipping held {1}@{2}'.format(local_dataset, dataset, ', '.join(held_names)))
+
+        # Destroy them all with the one zfs destroy
+        if len(destroy_list) > 1:
+            try:
+                ZFS.destroy_many(dataset, [names[i] for i in destroy_list], endpoint, log_command=log_command)
+                for i in destroy_list:
+                    snapshots.pop(handles[i])
+                destroy_list = []
+            except RuntimeError as ex:
+                # Nothing is destroyed if one fails, so go one by one
+                log_debug('[{0}] -   Batch destroy failed, destroying one by one - {1}'.format(local_dataset, str(ex)))
+        for i in destroy_list:
+            ZFS.destroy(dataset, names[i], endpoint, log_command=log_command)
+            snapshots.pop(handles[i])
+
+        log_info('[{0}] - Cleaning {1} complete'.format(local_dataset, dataset))
@@ -31,16 +31,19 @@ import re
 import errno
 import time
 import configparser
+from bisect import bisect_right
 from subprocess import SubprocessError
 
 from magcode.core.globals_ import *
 from magcode.core.utility import MagCodeConfigError
 from magcode.core.utility import get_numeric_setting
+from magcode.core.utility import get_boolean_setting
 
 from zsnap.globals_ import CLEANER_REGEX
 from zsnap.globals_ import DEFAULT_BUFFER_SIZE
 from zsnap.globals_ import TRIGGER_FILENAME
 from zsnap.zfs import ZFS
+from zsnap.helper import Helper
 
 TEMPLATE_KEY = r'{template}'
 TRIGGER_STR = r'trigger'
@@ -57,8 +60,9 @@ TMP_HRMINRANGESTRVAL_REGEX = r'(' + TMP_STRVAL_REGEX + r'|' + TMP_HRMIN_REGEX +
 TM_HRMINRANGESTRVAL_REGEX = r'^' + TMP_HRMINRANGESTRVAL_REGEX + r'$'
 TMP_HRMINCOMMA_REGEX = r'(' + TMP_HRMIN_REGEX + r'\s*,\s*){1,}' + TMP_HRMIN_REGEX
 TM_HRMINCOMMA_REGEX  = r'^' + TMP_HRMINCOMMA_REGEX + r'$'
-TMP_HRMINRANGESTRVALCOMMA_REGEX = r'(' + TMP_HRMINRANGESTRVAL_REGEX + r'\s*,\s*){1,}' + TMP_HRMINRANGESTRVAL_REGEX
-TM_HRMINRANGESTRVALCOMMA_REGEX  = r'^' + TMP_HRMINRANGESTRVALCOMMA_REGEX + r'$'
+TM_HRMIN_RE = re.compile(TM_HRMIN_REGEX)
+TM_RANGE_RE = re.compile(TM_RANGE_REGEX)
+TM_HRMINRANGESTRVAL_RE = re.compile(TM_HRMINRANGESTRVAL_REGEX)
 
 ds_name_syntax = r'^[-_:.a-zA-Z0-9][-_:./a-zA-Z0-9]*$'
 ds_name_reserved_regex = r'^(log|DEFAULT|(c[0-9]|log/|mirror|raidz|raidz1|raidz2|raidz3|spare).*)$'
@@ -130,10 +134,26 @@ ds_syntax_dict = {'snapshot': BOOLEAN_REGEX,
         'remote2_clean_all': BOOLEAN_REGEX,
         'template': template_name_syntax,
         }
+BOOLEAN_VALUES = frozenset(('True', 'true', 'False', 'false', 'On', 'on', 'Off', 'off', '0', '1'))
+
+def _check_boolean_syntax(section_name, item, value, checking_template=False):
+    """
+    Function called to check boolean syntax, a set lookup rather than a regex match
+    """
+    if value not in BOOLEAN_VALUES:
+        log_error("[{0}] {1} - value '{2}' invalid. Must match regex '{3}'.".format(section_name, item, value, BOOLEAN_REGEX))
+        return False
+    return True
+
+# Every item of every section is checked, so compile the patterns once
+ds_syntax_dict = {item: _check_boolean_syntax if syntax == BOOLEAN_REGEX else re.compile(syntax) if syntax else syntax
+        for item, syntax in ds_syntax_dict.items()}
+ds_name_re = re.compile(ds_name_syntax)
+ds_name_reserved_re = re.compile(ds_name_reserved_regex)
+template_name_re = re.compile(template_name_syntax)
 DEFAULT_ENDPOINT_LOGIN = 'root'
 DEFAULT_ENDPOINT_PORT = 22
 DEFAULT_ENDPOINT_CMD = 'ssh -l {login} -p {port} {host}'
-DATE_SPEC = '%Y%m%d '
 ZFS_MOUNTPOINT_NONE = ('legacy', 'none')
 
 
@@ -142,12 +162,13 @@ def _check_time_syntax(section_name, item, time_spec, checking_template=False):
     Function called to check time spec syntax
     """
     if (',' in time_spec):
-        if (re.match(TM_HRMINRANGESTRVALCOMMA_REGEX, time_spec) is None):
+        # Each comma separated item on its own, rather than one regex over the lot
+        if not all(TM_HRMINRANGESTRVAL_RE.match(ts.strip()) for ts in time_spec.split(',')):
             log_error("[{0}] {1} - value '{2}' invalid. Must be of form 'HH:MM, HH:MM, HH:MM-HH:MM/[HH:MM|HH|H], {3}, {4}, ...'."
                     .format(section_name, item, time_spec, TEMPLATE_KEY, TRIGGER_STR))
             return False
     else:
-        if (re.match(TM_HRMINRANGESTRVAL_REGEX, time_spec) is None):
+        if (TM_HRMINRANGESTRVAL_RE.match(time_spec) is None):
             log_error("[{0}] {1} - value '{2}' invalid. Must be of form 'HH:MM', 'HH:MM-HH:MM/[HH:MM|HH|H]', '{3}' or '{4}'."
                     .format(section_name, item, time_spec, TEMPLATE_KEY, TRIGGER_STR))
             return False
@@ -171,6 +192,8 @@ class MeterTime(object):
     Manages the passing of time on a daily cycle, and the parsing of 
     time strings for that cycle
     """
+    # Parsed time lists for the day, shared by datasets with the same time spec
+    _time_lists = {}
 
     def __init__(self, dataset='', time_spec='', mountpoint=''):
         """
@@ -181,30 +204,57 @@ class MeterTime(object):
         self.dataset = dataset
         self.mountpoint = mountpoint
         self.time_spec = time_spec
-        self.date = self._midnight_date()
+        self.date = self.midnight_date()
         # Do this before calling _parse_timespec(), as that routine sets it!
         self.trigger_flag = False
-        self.time_list = self._parse_timespec(self.time_spec) if self.time_spec else []
+        self.time_list = self._day_time_list()
 
     def __repr__(self):
         return '{0}'.format(self.time_spec)
 
+    def _day_time_list(self):
+        """
+        Returns the time list for the time spec on the current date, parsing it
+        only if no other dataset has the same one
+        """
+        if not self.time_spec:
+            return []
+        key = (self.time_spec, self.date)
+        if key not in MeterTime._time_lists:
+            # Only keep the one day's lists
+            if any(date != self.date for time_spec, date in MeterTime._time_lists):
+                MeterTime._time_lists.clear()
+            # Parsing sets trigger_flag, which depends only on the time spec
+            time_list = self._parse_timespec(self.time_spec)
+            MeterTime._time_lists[key] = (time_list, self.trigger_flag)
+        time_list, trigger_flag = MeterTime._time_lists[key]
+        self.trigger_flag = self.trigger_flag or trigger_flag
+        return time_list
+
     def __iter__(self):
         yield from self.time_list
 
     def __call__(self, time_spec, section_name, item):
         return (self._parse_timespec(time_spec, section_name, item, syntax_check=True))
 
-    def _midnight_date(self):
-        date = time.strftime(DATE_SPEC, time.localtime())
-        return(int(time.mktime(time.strptime(date + '00:00', DATE_SPEC + '%H:%M'))))
+    @staticmethod
+    def midnight_date(today=None):
+        """
+        Returns the epoch time of midnight at the start of today, or of the
+        given struct_time
+        """
+        today = time.localtime() if today is None else today
+        return(int(time.mktime((today.tm_year, today.tm_mon, today.tm_mday, 0, 0, 0, 0, 0, -1))))
 
     def _parse_timespec(self, time_spec, section_name=None, item=None, syntax_check=False):
         """
         Parse a time spec
         """
         def parse_hrmin(time_spec):
-            return(int(time.mktime(time.strptime(date + time_spec, DATE_SPEC + '%H:%M'))))
+            hour, minute = time_spec.split(':')
+            # Straight to mktime, rather than formatting and parsing a date string
+            return(int(time.mktime((today.tm_year, today.tm_mon, today.tm_mday,
+                    int(hour), int(minute), 0, 0, 0, -1))))
 
         def parse_range(time_spec):
             tm_list = []
@@ -246,14 +296,14 @@ class MeterTime(object):
                 if syntax_check:
                     return([1,])
                 return([])
-            if re.match(TM_HRMIN_REGEX, time_spec):
+            if TM_HRMIN_RE.match(time_spec):
                 return ([parse_hrmin(time_spec)])
-            if re.match(TM_RANGE_REGEX, time_spec):
+            if TM_RANGE_RE.match(time_spec):
                 return(parse_range(time_spec))
             raise Exception('Parsing time specs, should not have got here!')
 
         parse_flag = True
-        date = time.strftime(DATE_SPEC, time.localtime())
+        today = time.localtime()
         time_list = []
         spec_list = time_spec.split(',')
         spec_list = [ts.strip() for ts in spec_list]
@@ -268,58 +318,74 @@ class MeterTime(object):
     def is_trigger(self):
         return self.trigger_flag
 
-    def do_run(self, now):
+    def do_run(self, now, midnight_epoch=None):
         """
-        Check if time has passed for a dataset, or for a .trigger file
+        Check if time has passed for a dataset, or for a .trigger file.
+        midnight_epoch is normally worked out once per poll by the caller.
         """
-        # Reinitialise time_list
-        now_date = self._midnight_date()
-        if (now_date > self.date):
+        if midnight_epoch is None:
+            midnight_epoch = self.midnight_date()
+        if (midnight_epoch > self.date):
             # Now a new day, reinitialise time_list
-            self.date = now_date
-            self.time_list = self._parse_timespec(self.time_spec) if self.time_spec else []
+            self.date = midnight_epoch
+            self.time_list = self._day_time_list()
         # Trigger file
         if self.is_trigger():
             # We wait until we find a trigger file in the filesystem
             trigger_filename = '{0}/{1}'.format(self.mountpoint, TRIGGER_FILENAME)
-            if os.path.exists(trigger_filename):
-                log_info("[{0}] - trigger file '{1}' found".format(self.dataset, trigger_filename))
+            try:
+                # Removing it straight off tells us if it was there
                 os.remove(trigger_filename)
+            except FileNotFoundError:
+                pass
+            else:
+                log_info("[{0}] - trigger file '{1}' found".format(self.dataset, trigger_filename))
                 self.prev_secs = now
                 return True
-        # Check for Time passed
-        prev_secs = self.prev_secs
-        for inst in self.time_list:
-            if ( prev_secs < inst <= now):
-                log_info('[{0}] - time passed has passed'.format(self.dataset))
-                self.prev_secs = now
-                return True
+        # Check for Time passed - time_list is sorted, so find the first time after
+        # the last check
+        index = bisect_right(self.time_list, self.prev_secs)
+        if (index < len(self.time_list) and self.time_list[index] <= now):
+            log_info('[{0}] - time passed has passed'.format(self.dataset))
+            self.prev_secs = now
+            return True
         self.prev_secs = now
         return False
 
+class DatasetSettings(dict):
+    """
+    Dataset settings dictionary, keyed by dataset name.  Also carries lookup
+    tables that are worked out once when the configuration is read.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trigger_mnts_dict = {}
+        # Datasets listed by zfs when the configuration was read
+        self.datasets = {}
+
 class Config(object):
     @staticmethod
     def _check_section_syntax(section, section_name, checking_template=False):
         result = True
         for item in section.keys():
-            try:
-                value_syntax = ds_syntax_dict[item]
-            except KeyError as ex:
+            if item not in ds_syntax_dict:
                 log_error("[{0}] - item '{1}' is not a valid dataset keyword.".format(section_name, item))
                 result = False
                 continue
-            if (not ds_syntax_dict[item]):
+            value_syntax = ds_syntax_dict[item]
+            if (not value_syntax):
                 continue
             value = section[item]
-            if type(ds_syntax_dict[item]) == type(_check_time_syntax):
-                if not ds_syntax_dict[item](section_name, item, value, checking_template):
+            if callable(value_syntax):
+                if not value_syntax(section_name, item, value, checking_template):
                     result = False
                 continue
-            if (not re.match(ds_syntax_dict[item], value)):
-                log_error("[{0}] {1} - value '{2}' invalid. Must match regex '{3}'.".format(section_name, item, value, ds_syntax_dict[item]))
+            if (not value_syntax.match(value)):
+                log_error("[{0}] {1} - value '{2}' invalid. Must match regex '{3}'.".format(section_name, item, value, value_syntax.pattern))
                 result = False
             if item in ('replicate_source', 'replicate_target'):
-                if re.match(ds_name_reserved_regex, value):
+                if ds_name_reserved_re.match(value):
                     log_error("[{0}] {1} - value '{2}' invalid. Must not start with a ZFS reserved keyword.".format(section_name, item, value))
                     result = False
         return result
@@ -335,7 +401,7 @@ class Config(object):
             result = False
         for template in template_config.sections():
             # Check name syntax of each dataset group
-            if not re.match(template_name_syntax, template):
+            if not template_name_re.match(template):
                 log_error("Template name '{0}' is invalid.".format(template))
                 result = False
             # Check syntax of each dataset group 
@@ -351,8 +417,8 @@ class Config(object):
         """
         result = True
         for dataset in ds_config.sections():
-            if (not re.match(ds_name_syntax, dataset)
-                    or re.match(ds_name_reserved_regex, dataset)):
+            if (not ds_name_re.match(dataset)
+                    or ds_name_reserved_re.match(dataset)):
                 log_error("Dataset name '{0}' is invalid.".format(dataset))
                 result = False
             if not Config._check_section_syntax(ds_config[dataset], dataset):
@@ -368,18 +434,33 @@ class Config(object):
         """
         Read dataset configuration
         """
-        def read_config(filename, dirname=None, default_dict=None):
-            file_ = open(filename)
-            config = configparser.ConfigParser()
-            if default_dict:
-                config.read_dict(default_dict)
-            config.read_file(file_)
+        def read_sources(filename, dirname=None):
+            """
+            Reads in the text of a config file and the files in its directory
+            """
+            with open(filename) as file_:
+                sources = [(filename, file_.read())]
             if dirname:
                 file_list = []
+                # Files from every directory under dirname, in a stable order
                 for root, dirs, files in os.walk(dirname):
-                    file_list = [os.path.join(root, name) for name in files]
-                config.read(file_list)
-            file_.close()
+                    dirs.sort()
+                    file_list.extend(os.path.join(root, name) for name in sorted(files))
+                for name in file_list:
+                    # Unreadable files are skipped, as ConfigParser.read() does
+                    try:
+                        with open(name) as file_:
+                            sources.append((name, file_.read()))
+                    except OSError:
+                        continue
+            return sources
+
+        def read_config(sources, default_dict=None):
+            config = configparser.ConfigParser()
+            if default_dict:
+                config.read_dict(default_dict)
+            for source, text in sources:
+                config.read_string(text, source)
             return config
 
         def check_ds_config_clash(setting_name1, setting_name2, fallback1=False, fallback2=False):
@@ -401,13 +482,13 @@ class Config(object):
                 invalid_config = True
             return (setting1, setting2)
 
-        ds_settings = {}
+        ds_settings = DatasetSettings()
         ds_dict = {}
         template_dict = {}
         try:
             template_filename = settings['template_config_file']
             template_dirname = settings['template_config_dir']
-            template_config = read_config(template_filename, template_dirname)
+            template_config = read_config(read_sources(template_filename, template_dirname))
             if not Config._check_template_syntax(template_config):
                 raise MagCodeConfigError("Invalid dataset syntax in config file/dir '{0}' or '{1}'"
                         .format(template_filename, template_dirname))
@@ -425,7 +506,8 @@ class Config(object):
             
             ds_filename = settings['dataset_config_file']
             ds_dirname = settings['dataset_config_dir']
-            ds_config = read_config(ds_filename, ds_dirname)
+            ds_sources = read_sources(ds_filename, ds_dirname)
+            ds_config = read_config(ds_sources)
             invalid_config = not bool(Config._check_dataset_syntax(ds_config))
             if invalid_config:
                 raise MagCodeConfigError("Invalid dataset syntax in config file/dir '{0}' or '{1}'"
@@ -438,11 +520,19 @@ class Config(object):
                 if (ds_template and ds_template in template_dict):
                     ds_dict[ds] = template_dict.get(ds_template, None)
 
-            # Destroy ds_config and re read it
-            del ds_config
-            ds_config = read_config(ds_filename, ds_dirname, ds_dict)
+            # Parse again from the text already read, with the templates under the
+            # dataset settings. Nothing to layer if no dataset uses a template
+            if ds_dict:
+                ds_config = read_config(ds_sources, ds_dict)
             datasets = ZFS.get_datasets()
+            ds_settings.datasets = datasets
+            ssh_control_master = get_boolean_setting('ssh_control_master')
+            ssh_cipher = settings['ssh_cipher']
             for dataset in ds_config.sections():
+                # Names added to replicate targets by the append_fullname/basename settings
+                slash = dataset.find('/')
+                fullname_suffix = dataset[slash:] if slash != -1 else ''
+                basename_suffix = dataset[dataset.rfind('/'):] if slash != -1 else ''
                 # Calculate mountpoint
                 zfs_mountpoint = None
                 if dataset in datasets:
@@ -508,6 +598,9 @@ class Config(object):
                             endpoint = ''
                     else:
                         endpoint = ds_config.get(dataset, 'replicate_endpoint')
+                    endpoint = Helper.ssh_cipher_endpoint(endpoint, ssh_cipher)
+                    if ssh_control_master:
+                        endpoint = Helper.ssh_control_endpoint(endpoint)
                     full_clone = ds_config.getboolean(dataset, 'replicate_full_clone', fallback=False)
                     send_properties = ds_config.getboolean(dataset, 'replicate_send_properties', fallback=False)
                     append_basename, append_fullname = check_ds_config_clash('replicate_append_basename', 'replicate_append_fullname')
@@ -518,10 +611,10 @@ class Config(object):
                         receive_no_mountpoint = False
 
                     append_name = ''
-                    if (append_fullname and dataset.find('/') != -1):
-                        append_name = dataset[dataset.find('/'):]
-                    if (append_basename and dataset.rfind('/') != -1):
-                        append_name = dataset[dataset.rfind('/'):]
+                    if append_fullname:
+                        append_name = fullname_suffix
+                    if append_basename:
+                        append_name = basename_suffix
                     if (receive_mountpoint):
                         receive_mountpoint = str(receive_mountpoint) + append_name
                     target = ds_config.get(dataset, 'replicate_target', fallback=None)
@@ -561,6 +654,9 @@ class Config(object):
                             endpoint = ''
                     else:
                         endpoint = ds_config.get(dataset, 'replicate2_endpoint')
+                    endpoint = Helper.ssh_cipher_endpoint(endpoint, ssh_cipher)
+                    if ssh_control_master:
+                        endpoint = Helper.ssh_control_endpoint(endpoint)
                     full_clone = ds_config.getboolean(dataset, 'replicate2_full_clone', fallback=False)
                     send_properties = ds_config.getboolean(dataset, 'replicate2_send_properties', fallback=False)
                     append_basename, append_fullname = check_ds_config_clash('replicate2_append_basename', 'replicate2_append_fullname')
@@ -571,10 +667,10 @@ class Config(object):
                         receive_no_mountpoint = False
 
                     append_name = ''
-                    if (append_fullname and dataset.find('/') != -1):
-                        append_name = dataset[dataset.find('/'):]
-                    if (append_basename and dataset.rfind('/') != -1):
-                        append_name = dataset[dataset.rfind('/'):]
+                    if append_fullname:
+                        append_name = fullname_suffix
+                    if append_basename:
+                        append_name = basename_suffix
                     if (receive_mountpoint):
                         receive_mountpoint = str(receive_mountpoint) + append_name
                     target = ds_config.get(dataset, 'replicate2_target', fallback=None)
@@ -606,6 +702,9 @@ class Config(object):
             if invalid_config:
                 raise MagCodeConfigError("Invalid dataset syntax in config file/dir '{0}', '{1}', '{2}', or '{3}'"
                         .format(template_filename, template_dirname, ds_filename, ds_dirname))
+
+            # Reverse map of trigger mount points to datasets, used by zsnapd-trigger
+            ds_settings.trigger_mnts_dict = {dss['mountpoint']:ds for ds, dss in ds_settings.items() if dss['time'].is_trigger()}
        
         # Handle file opening and read errors
         except (IOError,OSError) as e:
@@ -43,6 +43,17 @@ settings['sleep_time'] = 300 # seconds
 settings['debug_sleep_time'] = 15 # seconds
 settings['startup_hysteresis_time'] = 15 # seconds
 settings['connect_retry_wait'] = 3 # seconds
+settings['dns_cache_ttl'] = 300 # seconds
+# Number of datasets cleaned and replicated at once - 1 does them in turn
+settings['parallel_datasets'] = 1
+# Seconds the local snapshot list is reused between runs - 0 lists it every run
+settings['snapshot_cache_ttl'] = 0 # seconds
+# Share one ssh connection per replication endpoint during each run - off by default
+settings['ssh_control_master'] = False
+settings['ssh_control_persist'] = 60 # seconds
+settings['ssh_control_dir'] = settings['run_dir'] + '/' + 'zsnapd-ssh'
+# Cipher for ssh endpoints that don't pick one, eg aes128-gcm@openssh.com - empty leaves it to ssh
+settings['ssh_cipher'] = ''
 
 settings['zfs_proc_not_mounts'] = ('/var/lib/lxd/devices',)
 def read_proc_mounts():
@@ -50,6 +50,7 @@ settings['rcmd_zfs_hold'] = ''
 settings['rcmd_zfs_release'] = ''
 settings['rcmd_zfs_get_size'] = ''
 settings['rcmd_zfs_get_size2'] = ''
+settings['rcmd_zfs_get_written'] = ''
 settings['rcmd_zfs_destroy'] = ''
 settings['rcmd_zfs_receive_abort'] = ''
 settings['rcmd_zfs_get_receive_resume_token'] = ''
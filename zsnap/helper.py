@@ -25,13 +25,23 @@ Provides basic helper functionality
 
 import re
 import sys
-from subprocess import Popen, PIPE
+import hashlib
+from subprocess import Popen, PIPE, DEVNULL
+from tempfile import TemporaryFile
 
+from magcode.core.globals_ import settings
 from magcode.core.globals_ import debug_extreme
 from magcode.core.globals_ import log_debug
 from magcode.core.globals_ import log_info
 from magcode.core.globals_ import log_error
 
+# Characters stripped from command output
+OUTPUT_FILTER_RE = re.compile(r'[^\n\t@ a-zA-Z0-9_\\.:/\-]+')
+# Local zfs commands with nothing for a shell to do, so they can be run directly
+PLAIN_ZFS_COMMAND_RE = re.compile(r'^zfs( [a-zA-Z0-9_@:/.,\-]+)+$')
+# Start of ssh endpoint commands set up for connection sharing
+SSH_CONTROL_PREFIX = 'ssh -o ControlMaster=no -o ControlPath='
+
 
 class Helper(object):
     """
@@ -51,8 +61,14 @@ class Helper(object):
             log_debug("Executing command: '{0}'".format(command))
         elif debug_extreme():
             log_debug("Executing command: '{0}'".format(command))
-        pattern = re.compile(r'[^\n\t@ a-zA-Z0-9_\\.:/\-]+')
-        process = Popen(command, shell=True, cwd=cwd, stdout=PIPE, stderr=PIPE)
+        if PLAIN_ZFS_COMMAND_RE.match(command):
+            # Saves starting a shell just to run zfs
+            try:
+                process = Popen(command.split(' '), cwd=cwd, stdout=PIPE, stderr=PIPE)
+            except OSError as ex:
+                raise RuntimeError('{0} failed with error message: {1}'.format(command, str(ex)))
+        else:
+            process = Popen(command, shell=True, cwd=cwd, stdout=PIPE, stderr=PIPE)
         out, err = process.communicate()
         # Clean up output
         if (sys.version_info.major >= 3):
@@ -63,5 +79,78 @@ class Helper(object):
         if return_code != 0:
             if (not filter_error or err.find(filter_error) == -1):
                raise RuntimeError('{0} failed with return value {1} and error message: {2}'.format(command, return_code, err))
-        return re.sub(pattern, '', out)
+        return OUTPUT_FILTER_RE.sub('', out)
 
+    @staticmethod
+    def run_command_iter(command, cwd, log_command=False):
+        """
+        Executes a command, yielding the output a line at a time so large listings
+        are not held in memory. If the command fails, it raises once the output is read
+        """
+        if log_command:
+            log_debug("Executing command: '{0}'".format(command))
+        elif debug_extreme():
+            log_debug("Executing command: '{0}'".format(command))
+        # stderr goes to a file, so a chatty command can't block on a full pipe
+        with TemporaryFile() as err_file:
+            process = Popen(command, shell=True, cwd=cwd, stdout=PIPE, stderr=err_file,
+                    universal_newlines=True, encoding='utf-8')
+            with process.stdout:
+                for line in process.stdout:
+                    yield OUTPUT_FILTER_RE.sub('', line.rstrip('\n'))
+            return_code = process.wait()
+            if return_code != 0:
+                err_file.seek(0)
+                err = err_file.read().decode(encoding='utf-8').strip()
+                raise RuntimeError('{0} failed with return value {1} and error message: {2}'.format(command, return_code, err))
+
+    @staticmethod
+    def ssh_cipher_endpoint(endpoint, cipher):
+        """
+        Sets the cipher for an ssh endpoint command that doesn't give one, and turns
+        off ssh compression
+        """
+        if not cipher or not endpoint.startswith('ssh ') or ' -c ' in endpoint:
+            return endpoint
+        return 'ssh -c {0} -o Compression=no{1}'.format(cipher, endpoint[len('ssh'):])
+
+    @staticmethod
+    def ssh_control_endpoint(endpoint):
+        """
+        Sets up an ssh endpoint command to use a shared master connection, if one is running
+        """
+        if not endpoint.startswith('ssh ') or endpoint.startswith(SSH_CONTROL_PREFIX):
+            return endpoint
+        # %C only covers the hosts, port and user, so endpoints differing in keys or
+        # other options get their own master through a hash of the whole command
+        endpoint_hash = hashlib.sha1(endpoint.encode()).hexdigest()[:16]
+        return '{0}{1}/{2}-%C{3}'.format(SSH_CONTROL_PREFIX, settings['ssh_control_dir'], endpoint_hash,
+                endpoint[len('ssh'):])
+
+    @staticmethod
+    def start_ssh_master(endpoint):
+        """
+        Starts a shared ssh master connection in the background for an endpoint.
+        Returns True if there is one running
+        """
+        if not endpoint.startswith(SSH_CONTROL_PREFIX):
+            return False
+        ssh_args = endpoint[len('ssh'):]
+        if Popen('ssh -O check' + ssh_args, shell=True, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL).wait() == 0:
+            return True
+        # Keepalives, so a master whose link has died exits instead of stalling
+        # every command sharing it
+        command = ('ssh -o ControlMaster=yes -o ControlPersist={0} -o ServerAliveInterval=15 -o ServerAliveCountMax=3 -f -N{1}'
+                .format(settings['ssh_control_persist'], ssh_args))
+        log_debug("Starting ssh master: '{0}'".format(command))
+        # Nothing can be left holding pipes open, as the master runs on after ssh -f returns
+        return Popen(command, shell=True, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL).wait() == 0
+
+    @staticmethod
+    def stop_ssh_master(endpoint):
+        """
+        Stops the shared ssh master connection for an endpoint
+        """
+        if not endpoint.startswith(SSH_CONTROL_PREFIX):
+            return
+        Popen('ssh -O exit' + endpoint[len('ssh'):], shell=True, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL).wait()
@@ -27,16 +27,22 @@ Provides the overall functionality
 import time
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
 from socket import gethostname
+from socket import getaddrinfo
+from socket import IPPROTO_TCP
 
 from magcode.core.globals_ import *
 from magcode.core.utility import connect_test_address
 from magcode.core.utility import get_numeric_setting
+from magcode.core.utility import get_boolean_setting
 
 from zsnap.zfs import ZFS
 from zsnap.clean import Cleaner
 from zsnap.helper import Helper
+from zsnap.config import MeterTime
 from zsnap.globals_ import SNAPSHOTNAME_FMTSPEC
 from zsnap.globals_ import SNAPSHOTNAME_REGEX
 from zsnap.globals_ import TRIGGER_FILENAME
@@ -45,30 +51,75 @@ PROC_FAILURE = 0
 PROC_EXECUTED = 1
 PROC_CHANGED = 2
 
+# Short host name, used in replication log messages
+LOCAL_HOSTNAME = gethostname().split('.')[0]
+SNAPSHOTNAME_RE = re.compile(SNAPSHOTNAME_REGEX)
+
 class IsConnected(object):
     """
     Test object class for caching endpoint connectivity and testing for it as well
     """
+    # Most endpoints and host names remembered
+    max_endpoints = 1024
+
     def __init__(self):
-        self.unconnected_list = []
-        self.connected_list = []
+        # (host, port) -> (connected, time tested), least recently used first
+        self.endpoints = OrderedDict()
+        self.dns_cache = OrderedDict()
+        # Datasets may be run in parallel threads
+        self.lock = threading.Lock()
+
+    def expire(self, ttl):
+        """
+        Forget endpoint connectivity results older than ttl seconds
+        """
+        with self.lock:
+            self._expire(ttl)
+
+    def _expire(self, ttl):
+        expire_time = time.time() - ttl
+        for endpoint in [e for e in self.endpoints if self.endpoints[e][1] < expire_time]:
+            del self.endpoints[endpoint]
 
-    def _test_connected(self, host, port):
+    def _resolve(self, host, port):
+        """
+        Resolve host to an IP address, cached for dns_cache_ttl seconds
+        """
+        now = time.time()
+        with self.lock:
+            ip, expires_at = self.dns_cache.get(host, (None, 0))
+        if expires_at > now:
+            return ip
+        # Looked up outside the lock, so a slow DNS server holds up no one else
+        ip = getaddrinfo(host, port, proto=IPPROTO_TCP)[0][4][0]
+        with self.lock:
+            self.dns_cache[host] = (ip, now + get_numeric_setting('dns_cache_ttl', float))
+            if len(self.dns_cache) > self.max_endpoints:
+                self.dns_cache.popitem(last=False)
+        log_debug("Resolved '{0}' -> '{1}'".format(host, ip))
+        return ip
+
+    def _test_connected(self, host, port, local_dataset):
         connect_retry_wait = get_numeric_setting('connect_retry_wait', float)
         exc_msg = ''
         for t in range(3):
             try:
                 # Transform any hostname to an IP address
-                connect_test_address(host, port)
+                connect_test_address(self._resolve(host, port), port)
                 break
             except(IOError, OSError) as exc:
                 exc_msg = str(exc)
-                time.sleep(connect_retry_wait)
+                # Address may have changed, so resolve again on retry
+                with self.lock:
+                    self.dns_cache.pop(host, None)
+                # No point waiting after the last attempt
+                if t < 2:
+                    time.sleep(connect_retry_wait)
                 continue
         else:
-            if self.local_dataset:
+            if local_dataset:
                 log_info("[{0}] - Can't reach endpoint '{1}:{2}' - {3}"
-                        .format(self.local_dataset, host, port, exc_msg))
+                        .format(local_dataset, host, port, exc_msg))
             else:
                 log_error("Can't reach endpoint '{0}:{1}' - {2}".format(host, port, exc_msg))
             return False
@@ -78,25 +129,47 @@ class IsConnected(object):
         """
         Check that endpoint is unconnected
         """
-        self.local_dataset = local_dataset
-        if (replicate_param and replicate_param['endpoint_host']):
-            host = replicate_param['endpoint_host']
-            port = replicate_param['endpoint_port']
-            if ((host, port) in self.unconnected_list):
-                return(True)
-            if ((host, port) not in self.connected_list):
-                if self._test_connected(host, port):
-                    self.connected_list.append((host, port))
-                    # Go and write trigger
-                else:
-                    self.unconnected_list.append((host, port))
-                    return(True)
-        return(False)
+        if not (replicate_param and replicate_param['endpoint_host']):
+            return(False)
+        host = replicate_param['endpoint_host']
+        port = replicate_param['endpoint_port']
+        endpoint = (host, port)
+        with self.lock:
+            if endpoint in self.endpoints:
+                self.endpoints.move_to_end(endpoint)
+                return(not self.endpoints[endpoint][0])
+        # Probed outside the lock, so an unreachable endpoint only holds up the
+        # datasets using it. Two threads may probe the same endpoint at once.
+        connected = self._test_connected(host, port, local_dataset)
+        with self.lock:
+            self.endpoints[endpoint] = (connected, time.time())
+            if len(self.endpoints) > self.max_endpoints:
+                self.endpoints.popitem(last=False)
+        return(not connected)
 
 class Manager(object):
     """
     Manages the ZFS snapshotting process
     """
+    # Shared across runs, so endpoint reachability and DNS results are kept
+    _is_connected = IsConnected()
+    # Local snapshot map kept between runs, and the time it was listed
+    _snapshots_cache = None
+    _snapshots_cache_time = 0
+
+    @staticmethod
+    def get_snapshots():
+        """
+        Lists the local snapshots, reusing the map kept from an earlier run if it
+        is newer than snapshot_cache_ttl seconds
+        """
+        now = time.time()
+        if (Manager._snapshots_cache is not None
+                and now - Manager._snapshots_cache_time < get_numeric_setting('snapshot_cache_ttl', float)):
+            return Manager._snapshots_cache
+        Manager._snapshots_cache = ZFS.get_snapshots()
+        Manager._snapshots_cache_time = now
+        return Manager._snapshots_cache
 
     @staticmethod
     def touch_trigger(ds_settings, test_reachable, do_trigger, *args):
@@ -104,11 +177,14 @@ class Manager(object):
         Runs around creating .trigger files for datasets with time = trigger
         """
         result = True
-        datasets = ZFS.get_datasets()
-        ds_candidates = [ds.rstrip('/') for ds in args if ds[0] != '/']
-        mnt_candidates = [m.rstrip('/') for m in args if m[0] == '/']
-        do_trigger_candidates = [ds for ds in ds_settings if ds_settings[ds]['do_trigger']]
-        trigger_mnts_dict = {ds_settings[ds]['mountpoint']:ds for ds in ds_settings if ds_settings[ds]['time'].is_trigger()}
+        # Listed moments ago when the configuration was read
+        datasets = ds_settings.datasets
+        # Split command line arguments into datasets and mount points in one pass
+        ds_candidates = []
+        mnt_candidates = []
+        for arg in args:
+            (mnt_candidates if arg[0] == '/' else ds_candidates).append(arg.rstrip('/'))
+        trigger_mnts_dict = ds_settings.trigger_mnts_dict
         if len(ds_candidates):
             for candidate in ds_candidates:
                 if candidate not in datasets:
@@ -128,7 +204,7 @@ class Manager(object):
                 ds_candidates.append(trigger_mnts_dict[candidate])
         # If no candidates given on comman line, process all those with do_trigger set
         if (do_trigger and not ds_candidates):
-            ds_candidates = do_trigger_candidates
+            ds_candidates = [ds for ds in ds_settings if ds_settings[ds]['do_trigger']]
         # If do_trigger, only process those datasets with do_trigger set
         elif (do_trigger and ds_candidates):
             for ds in ds_candidates:
@@ -145,43 +221,45 @@ class Manager(object):
             if (not ds_settings[ds]['mountpoint'] and settings['verbose']):
                 log_info("Dataset '{0}' does not have a mountpoint configured - skipping.".format(ds))
 
-        is_connected = IsConnected()
-        for dataset in datasets:
-            if dataset in ds_settings:
-                if (len(ds_candidates) and dataset not in ds_candidates):
-                    continue
-                try:
-                    dataset_settings = ds_settings[dataset]
-
-                    take_snapshot = dataset_settings['snapshot'] is True
-                    replicate = dataset_settings['replicate'] is not None
-                    clean = bool(dataset_settings['schema'])
-
-                    if take_snapshot is True or replicate is True or clean is True:
-                        if dataset_settings['time'].is_trigger() and dataset_settings['mountpoint']:
-                            # Check endpoint for trigger is connected
-                            if test_reachable and is_connected.test_unconnected(dataset_settings['replicate']):
-                                continue
-                            # Trigger file testing and creation
-                            trigger_filename = '{0}/{1}'.format(dataset_settings['mountpoint'], TRIGGER_FILENAME)
-                            if os.path.exists(trigger_filename):
-                                continue
-                            if (not os.path.isdir(dataset_settings['mountpoint'])):
-                                log_error("Directory '{0}' does not exist.".format(dataset_settings['mountpoint']))
-                                result = False
-                                continue
-                            trigger_file = open(trigger_filename, 'wt')
-                            trigger_file.close()
-                except Exception as ex:
-                    log_error('Exception: {0}'.format(str(ex)))
-        del is_connected
+        is_connected = Manager._is_connected
+        # Only walk the configured datasets that are candidates
+        ds_candidate_set = set(ds_candidates)
+        active_datasets = [ds for ds in datasets if ds in ds_settings and ds in ds_candidate_set]
+        for dataset in active_datasets:
+            try:
+                dataset_settings = ds_settings[dataset]
+
+                take_snapshot = dataset_settings['snapshot'] is True
+                replicate = dataset_settings['replicate'] is not None
+                clean = bool(dataset_settings['schema'])
+
+                if take_snapshot or replicate or clean:
+                    if dataset_settings['time'].is_trigger() and dataset_settings['mountpoint']:
+                        # Check endpoint for trigger is connected
+                        if test_reachable and is_connected.test_unconnected(dataset_settings['replicate']):
+                            continue
+                        # Trigger file testing and creation
+                        trigger_filename = '{0}/{1}'.format(dataset_settings['mountpoint'], TRIGGER_FILENAME)
+                        try:
+                            # Exclusive create, so one call both tests and makes the file
+                            fd = os.open(trigger_filename, os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_CLOEXEC, 0o644)
+                        except FileExistsError:
+                            continue
+                        except (FileNotFoundError, NotADirectoryError):
+                            log_error("Directory '{0}' does not exist.".format(dataset_settings['mountpoint']))
+                            result = False
+                            continue
+                        os.close(fd)
+            except (RuntimeError, OSError) as ex:
+                log_error('Exception: {0}'.format(str(ex)))
         return result
 
     @staticmethod
-    def snapshot(dataset, snapshots, now, local_dataset='', endpoint='', log_command=False):
+    def snapshot(dataset, snapshots, now, this_time=None, local_dataset='', endpoint='', log_command=False):
         local_dataset = dataset if not local_dataset else local_dataset
         result = PROC_EXECUTED
-        this_time = time.strftime(SNAPSHOTNAME_FMTSPEC, time.localtime(now))
+        if this_time is None:
+            this_time = time.strftime(SNAPSHOTNAME_FMTSPEC, time.localtime(now))
         # Take this_time's snapshotzfs
         log_info('[{0}] - Taking snapshot {1}@{2}'.format(local_dataset, dataset, this_time))
         try:
@@ -196,6 +274,39 @@ class Manager(object):
             result = PROC_CHANGED
         return result
 
+    @staticmethod
+    def snapshot_datasets(datasets, snapshots, now, this_time=None, log_command=False):
+        """
+        Takes the same snapshot of a number of local datasets, with one
+        atomic zfs snapshot per pool
+        """
+        results = {}
+        if this_time is None:
+            this_time = time.strftime(SNAPSHOTNAME_FMTSPEC, time.localtime(now))
+        pools = OrderedDict()
+        for dataset in datasets:
+            pools.setdefault(dataset.split('/')[0], []).append(dataset)
+        for pool, pool_datasets in pools.items():
+            if len(pool_datasets) == 1:
+                dataset = pool_datasets[0]
+                results[dataset] = Manager.snapshot(dataset, snapshots[dataset], now, this_time, log_command=log_command)
+                continue
+            for dataset in pool_datasets:
+                log_info('[{0}] - Taking snapshot {0}@{1}'.format(dataset, this_time))
+            try:
+                ZFS.snapshot_many(pool_datasets, this_time, log_command=log_command)
+            except (RuntimeError, OSError) as ex:
+                # Nothing is taken if one fails, so fall back to one at a time
+                log_error("[{0}] - Exception snapshotting pool '{0}' in one go: {1}".format(pool, str(ex)))
+                for dataset in pool_datasets:
+                    results[dataset] = Manager.snapshot(dataset, snapshots[dataset], now, this_time, log_command=log_command)
+                continue
+            for dataset in pool_datasets:
+                snapshots[dataset].update({this_time:{'name': this_time, 'creation': now}})
+                log_info('[{0}] - Taking snapshot {0}@{1} complete'.format(dataset, this_time))
+                results[dataset] = PROC_CHANGED
+        return results
+
     @staticmethod
     def new_hold(dataset, snap_name, endpoint='', log_command=False):
         result = PROC_EXECUTED
@@ -203,6 +314,14 @@ class Manager(object):
         ZFS.hold(dataset, snap_name, endpoint=endpoint, log_command=log_command, may_exist=True)
         if snap_name in holds:
             holds.remove(snap_name)
+        # Release all the old holds in one go
+        if len(holds) > 1:
+            try:
+                ZFS.release_many(dataset, holds, endpoint=endpoint, log_command=log_command)
+                holds = []
+            except RuntimeError as ex:
+                # An older remote rcmd_zfs_release filter only allows one snapshot
+                log_debug('[{0}] -   Batch release failed, releasing one by one - {1}'.format(dataset, str(ex)))
         for hold in holds:
             ZFS.release(dataset, hold, endpoint=endpoint, log_command=log_command)
         result = PROC_CHANGED
@@ -215,8 +334,8 @@ class Manager(object):
         replicate_dirN = 'push' if push else 'pull'
         src_endpoint = '' if push else replicate_settings['endpoint']
         dst_endpoint = replicate_settings['endpoint'] if push else ''
-        src_host = gethostname().split('.')[0] if push else replicate_settings['endpoint_host']
-        dst_host = gethostname().split('.')[0] if not push else replicate_settings['endpoint_host']
+        src_host = LOCAL_HOSTNAME if push else replicate_settings['endpoint_host']
+        dst_host = LOCAL_HOSTNAME if not push else replicate_settings['endpoint_host']
         local_dataset = src_dataset if push else dst_dataset
         full_clone = replicate_settings['full_clone']
         receive_save = replicate_settings['receive_save']
@@ -255,7 +374,7 @@ class Manager(object):
                 dst_endpoint = ''
             new_dst_snapshots = ZFS.get_snapshots2(dst_dataset, dst_endpoint, log_command=log_command,
                     all_snapshots=all_snapshots)
-            snapshot = list(new_dst_snapshots)[-1]
+            snapshot = next(reversed(new_dst_snapshots))
             snap_name = new_dst_snapshots[snapshot]['name']
             Manager.new_hold(src_dataset, snap_name, endpoint=src_endpoint, log_command=log_command)
             Manager.new_hold(dst_dataset, snap_name, endpoint=dst_endpoint, log_command=log_command)
@@ -266,21 +385,18 @@ class Manager(object):
             return result
 
         log_info('[{0}] - Replicating [{1}]:{2} to [{3}]:{4}'.format(local_dataset, src_host, src_dataset, dst_host, dst_dataset))
-        last_common_snapshot = None
-        index_last_common_snapshot = None
-        # Search for the last src snapshot that is available in dst
-        for snapshot in src_snapshots:
-            if snapshot in dst_snapshots:
-                last_common_snapshot = snapshot
-                index_last_common_snapshot = list(src_snapshots).index(snapshot)
-        if last_common_snapshot is not None:  # There's a common snapshot
-            snaps_to_send = list(src_snapshots)[index_last_common_snapshot:]
-            # Remove first element as it is already at other end
-            snaps_to_send.pop(0)
+        # Search back from the newest src snapshot for the last one available in dst
+        src_list = list(src_snapshots)
+        index_last_common_snapshot = next((i for i in range(len(src_list) - 1, -1, -1)
+                if src_list[i] in dst_snapshots), None)
+        if index_last_common_snapshot is not None:  # There's a common snapshot
+            last_common_snapshot = src_list[index_last_common_snapshot]
+            # Everything after the common snapshot is not yet at other end
+            snaps_to_send = src_list[index_last_common_snapshot+1:]
             previous_snapshot = last_common_snapshot
             if full_clone or all_snapshots:
                 prevsnap_name = src_snapshots[previous_snapshot]['name']
-                snapshot = list(src_snapshots)[-1]
+                snapshot = src_list[-1]
                 snap_name = src_snapshots[snapshot]['name']
                 # There is a snapshot on this host that is not yet on the other side.
                 size = ZFS.get_size(src_dataset, prevsnap_name, snap_name, endpoint=src_endpoint, **extra_args)
@@ -289,26 +405,41 @@ class Manager(object):
                         direction=replicate_dirN, **extra_args)
                 Manager.new_hold(src_dataset, snap_name, endpoint=src_endpoint, log_command=log_command)
                 Manager.new_hold(dst_dataset, snap_name, endpoint=dst_endpoint, log_command=log_command)
-                for snapshot in snaps_to_send:
-                    dst_snapshots.update({snapshot:src_snapshots[snapshot]})
+                dst_snapshots.update((snapshot, src_snapshots[snapshot]) for snapshot in snaps_to_send)
                 result = PROC_CHANGED
             else:
-                for snapshot in snaps_to_send:
-                    prevsnap_name = src_snapshots[previous_snapshot]['name']
-                    snap_name = src_snapshots[snapshot]['name']
-                    # There is a snapshot on this host that is not yet on the other side.
-                    size = ZFS.get_size(src_dataset, prevsnap_name, snap_name, endpoint=src_endpoint, **extra_args)
-                    log_info('[{0}] -   {1}@{2} > {1}@{3} ({4})'.format(local_dataset, src_dataset, prevsnap_name, snap_name, size))
-                    ZFS.replicate(src_dataset, prevsnap_name, snap_name, dst_dataset, replicate_settings['endpoint'],
-                            direction=replicate_dirN, **extra_args)
-                    Manager.new_hold(src_dataset, snap_name, endpoint=src_endpoint, log_command=log_command)
-                    Manager.new_hold(dst_dataset, snap_name, endpoint=dst_endpoint, log_command=log_command)
-                    previous_snapshot = snapshot
-                    dst_snapshots.update({snapshot:src_snapshots[snapshot]})
-                    result = PROC_CHANGED
+                # Send each snapshot as an increment on the one before it
+                last_sent_name = None
+                try:
+                    for previous_snapshot, snapshot in zip(src_list[index_last_common_snapshot:], snaps_to_send):
+                        prevsnap_name = src_snapshots[previous_snapshot]['name']
+                        snap_name = src_snapshots[snapshot]['name']
+                        # There is a snapshot on this host that is not yet on the other side.
+                        size = ZFS.get_size(src_dataset, prevsnap_name, snap_name, endpoint=src_endpoint, **extra_args)
+                        log_info('[{0}] -   {1}@{2} > {1}@{3} ({4})'.format(local_dataset, src_dataset, prevsnap_name, snap_name, size))
+                        ZFS.replicate(src_dataset, prevsnap_name, snap_name, dst_dataset, replicate_settings['endpoint'],
+                                direction=replicate_dirN, **extra_args)
+                        last_sent_name = snap_name
+                        dst_snapshots[snapshot] = src_snapshots[snapshot]
+                        result = PROC_CHANGED
+                except Exception:
+                    # Hold what did get across, but a failed send usually means the
+                    # holds fail too, so keep the send error as the one raised
+                    if last_sent_name is not None:
+                        try:
+                            Manager.new_hold(src_dataset, last_sent_name, endpoint=src_endpoint, log_command=log_command)
+                            Manager.new_hold(dst_dataset, last_sent_name, endpoint=dst_endpoint, log_command=log_command)
+                        except (RuntimeError, OSError) as ex:
+                            log_error('[{0}] - Exception: {1}'.format(local_dataset, str(ex)))
+                    raise
+                # Only the newest common snapshot needs holding, so hold it once the
+                # sends are done
+                if last_sent_name is not None:
+                    Manager.new_hold(src_dataset, last_sent_name, endpoint=src_endpoint, log_command=log_command)
+                    Manager.new_hold(dst_dataset, last_sent_name, endpoint=dst_endpoint, log_command=log_command)
         elif len(src_snapshots) > 0:
             # No remote snapshot, full replication
-            snapshot = list(src_snapshots)[-1]
+            snapshot = next(reversed(src_snapshots))
             snap_name = src_snapshots[snapshot]['name']
             size = ZFS.get_size(src_dataset, None, snap_name, endpoint=src_endpoint, **extra_args)
             log_info('  {0}@         > {0}@{1} ({2})'.format(src_dataset, snap_name, size))
@@ -317,32 +448,284 @@ class Manager(object):
             Manager.new_hold(src_dataset, snap_name, endpoint=src_endpoint, log_command=log_command)
             ZFS.hold(dst_dataset, snap_name, endpoint=dst_endpoint, log_command=log_command)
             if full_clone:
-                for snapshot in src_snapshots:
-                    dst_snapshots.update({snapshot:src_snapshots[snapshot]})
+                dst_snapshots.update(src_snapshots)
             else:
-                dst_snapshots.update({snapshot:src_snapshots[snapshot]})
+                dst_snapshots[snapshot] = src_snapshots[snapshot]
             result = PROC_CHANGED
         log_info('[{0}] - Replicating [{1}]:{2} to [{3}]:{4} complete'.format(local_dataset, src_host, src_dataset, dst_host, dst_dataset))
         return result
 
     @staticmethod
-    def run(ds_settings, sleep_time):
+    def get_remote_snapshots(datasets, ds_settings, is_connected):
         """
-        Executes a single run where certain datasets might or might not be snapshotted
+        Lists the snapshots of the push replication targets of the datasets,
+        with one zfs list per endpoint
         """
-
-        snapshots = ZFS.get_snapshots()
-        datasets = ZFS.get_datasets()
-        is_connected = IsConnected()
+        targets = OrderedDict()
+        log_commands = {}
         for dataset in datasets:
-            if dataset not in ds_settings:
+            dataset_settings = ds_settings[dataset]
+            replicate_settings = dataset_settings['replicate']
+            if replicate_settings and replicate_settings['target'] is None:
+                # Pulled, so nothing to list at the other end
+                continue
+            for replicate_settings in (dataset_settings['replicate'], dataset_settings['replicate2']):
+                if not replicate_settings:
+                    continue
+                if is_connected.test_unconnected(replicate_settings, local_dataset=dataset):
+                    continue
+                key = (replicate_settings['endpoint'], dataset_settings['all_snapshots'])
+                targets.setdefault(key, []).append(replicate_settings['target'])
+                log_commands[key] = log_commands.get(key, False) or dataset_settings['log_commands']
+
+        remote_snapshots = {}
+        for key, target_datasets in targets.items():
+            endpoint, all_snapshots = key
+            try:
+                snapshots = ZFS.get_snapshots_many(target_datasets, endpoint, all_snapshots=all_snapshots,
+                        log_command=log_commands[key])
+            except (RuntimeError, OSError) as ex:
+                # Each dataset will list its own, as an older remote rcmd_zfs_get_snapshots2
+                # filter only allows one dataset per zfs list
+                log_debug("Listing snapshots in one go over '{0}' failed, listing per dataset - {1}"
+                        .format(endpoint, str(ex)))
                 continue
+            for target in target_datasets:
+                remote_snapshots[(endpoint, target, all_snapshots)] = snapshots[target]
+        return remote_snapshots
 
-            # Evaluate per dataset to make closer to actual snapshot time
-            # Can wander due to large volume transfers and replications
-            now = int(time.time())
-            this_time = time.strftime(SNAPSHOTNAME_FMTSPEC, time.localtime(now))
+    @staticmethod
+    def _run_dataset(dataset, local_snapshots, dataset_settings, result, is_connected, this_time, now, remote_snapshots_map):
+        """
+        Cleans, replicates and runs post execution commands for one due dataset
+        """
+        try:
+            take_snapshot = dataset_settings['snapshot'] is True
+            replicate = dataset_settings['replicate'] is not None
+            replicate2 = dataset_settings['replicate2'] is not None
+            replicate_settings = dataset_settings['replicate']
+            replicate2_settings = dataset_settings['replicate2']
+            log_command = dataset_settings['log_commands']
+            all_snapshots = dataset_settings['all_snapshots']
+            preexec = dataset_settings['preexec']
+            postexec = dataset_settings['postexec']
+            replicate_postexec = dataset_settings['replicate_postexec']
+
+            push = replicate_settings['target'] is not None if replicate else True
+            if push:
+                # Snapshot was taken in run, between the pre and post exectution
+                # commands
+                # Clean snapshots if one has been taken - clean will not execute
+                # if no snapshot taken
+                Cleaner.clean(dataset, local_snapshots, dataset_settings['schema'], log_command=log_command,
+                        all_snapshots=dataset_settings['clean_all'])
+
+                # Replicating, if required
+                result = PROC_FAILURE
+                result2 = PROC_FAILURE
+                if replicate:
+                    # If network replicating, check connectivity here
+                    test_unconnected = is_connected.test_unconnected(replicate_settings, local_dataset=dataset)
+                    if test_unconnected:
+                        log_info("[{0}] - Skipping as '{1}:{2}' unreachable"
+                                .format(dataset, replicate_settings['endpoint_host'], replicate_settings['endpoint_port']))
+                        return
+
+                    remote_dataset = replicate_settings['target']
+                    remote_snapshots = remote_snapshots_map.get((replicate_settings['endpoint'], remote_dataset, all_snapshots))
+                    if remote_snapshots is None:
+                        remote_snapshots = ZFS.get_snapshots2(remote_dataset, replicate_settings['endpoint'], log_command=log_command,
+                                all_snapshots=all_snapshots)
+                    result = Manager.replicate(dataset, local_snapshots, remote_dataset, remote_snapshots, replicate_settings)
+                    # Clean snapshots remotely if one has been taken - only kept snapshots will allow aging
+                    if (dataset_settings['remote_schema']):
+                        Cleaner.clean(remote_dataset, remote_snapshots, dataset_settings['remote_schema'], log_command=log_command,
+                                all_snapshots=dataset_settings['remote_clean_all'])
+                if replicate2:
+                    # If network replicating, check connectivity here
+                    test_unconnected = is_connected.test_unconnected(replicate2_settings, local_dataset=dataset)
+                    if test_unconnected:
+                        log_info("[{0}] - Skipping as '{1}:{2}' unreachable"
+                                .format(dataset, replicate2_settings['endpoint_host'], replicate2_settings['endpoint_port']))
+                        return
+
+                    remote_dataset = replicate2_settings['target']
+                    remote_snapshots = remote_snapshots_map.get((replicate2_settings['endpoint'], remote_dataset, all_snapshots))
+                    if remote_snapshots is None:
+                        remote_snapshots = ZFS.get_snapshots2(remote_dataset, replicate2_settings['endpoint'], log_command=log_command,
+                                all_snapshots=all_snapshots)
+                    result2 = Manager.replicate(dataset, local_snapshots, remote_dataset, remote_snapshots, replicate2_settings)
+                    # Clean snapshots remotely if one has been taken - only kept snapshots will allow aging
+                    if (dataset_settings['remote2_schema']):
+                        Cleaner.clean(remote_dataset, remote_snapshots, dataset_settings['remote2_schema'], log_command=log_command,
+                                all_snapshots=dataset_settings['remote2_clean_all'])
+                # Post execution command
+                if ((result or result2) and replicate_postexec is not None):
+                    Helper.run_command(replicate_postexec, '/', log_command=log_command)
+            else:
+                # Pull logic for remote site
+                # Replicating, if required
+                # Connectivity was checked above, before any snapshots were listed
+                remote_dataset = replicate_settings['target'] if push else replicate_settings['source']
+                remote_datasets = ZFS.get_datasets(replicate_settings['endpoint'], remote_dataset, log_command=log_command)
+                if remote_dataset not in remote_datasets:
+                    log_error("[{0}] - remote dataset '{1}' does not exist".format(dataset, remote_dataset))
+                    return
+                remote_snapshots = ZFS.get_snapshots2(remote_dataset, replicate_settings['endpoint'], log_command=log_command,
+                        all_snapshots=all_snapshots)
+                endpoint = replicate_settings['endpoint']
+                if (take_snapshot and this_time not in remote_snapshots):
+                    # Only execute everything here if needed
+
+                    # Remote Pre exectution command
+                    if preexec is not None:
+                        Helper.run_command(preexec, '/', endpoint=endpoint, log_command=log_command)
+
+                    # Take remote snapshot
+                    result = PROC_FAILURE
+                    result = Manager.snapshot(remote_dataset, remote_snapshots, now, this_time, endpoint=endpoint, local_dataset=dataset, log_command=log_command)
+                    # Clean remote snapshots if one has been taken - only kept snapshots will aging to happen
+                    Cleaner.clean(remote_dataset, remote_snapshots, dataset_settings['schema'], log_command=log_command,
+                            endpoint=endpoint, local_dataset=dataset, all_snapshots=dataset_settings['clean_all'])
+                    # Execute remote postexec command
+                    if result and postexec is not None:
+                            Helper.run_command(postexec, '/', endpoint=endpoint, log_command=log_command)
+
+                if replicate:
+                    result = PROC_FAILURE
+                    result = Manager.replicate(remote_dataset, remote_snapshots, dataset, local_snapshots, replicate_settings)
+                    # Clean snapshots locally if one has been taken - only kept snapshots will allow aging
+                    #if not replicate_settings['full_clone']:
+                    Cleaner.clean(dataset, local_snapshots, dataset_settings['local_schema'], log_command=log_command,
+                            all_snapshots=dataset_settings['local_clean_all'])
+                    # Post execution command
+                    if (result and replicate_postexec is not None):
+                        Helper.run_command(replicate_postexec, '/', endpoint=endpoint, log_command=log_command)
+
+        except (RuntimeError, OSError) as ex:
+            log_error('[{0}] - Exception: {1}'.format(dataset, str(ex)))
+            # Part done, so the kept snapshot map may be out of step
+            Manager._snapshots_cache = None
+
+    @staticmethod
+    def start_ssh_masters(datasets, ds_settings, is_connected):
+        """
+        Starts a shared ssh master connection for each reachable replication endpoint
+        of the datasets. Returns the endpoints started
+        """
+        if not get_boolean_setting('ssh_control_master'):
+            return []
+        endpoints = []
+        for dataset in datasets:
+            dataset_settings = ds_settings[dataset]
+            replicate_settings = dataset_settings['replicate']
+            push = replicate_settings['target'] is not None if replicate_settings else True
+            all_replicate_settings = (replicate_settings, dataset_settings['replicate2']) if push else (replicate_settings,)
+            for replicate_settings in all_replicate_settings:
+                if not replicate_settings or replicate_settings['endpoint'] in endpoints:
+                    continue
+                if is_connected.test_unconnected(replicate_settings, local_dataset=dataset):
+                    continue
+                if Helper.start_ssh_master(replicate_settings['endpoint']):
+                    endpoints.append(replicate_settings['endpoint'])
+        return endpoints
+
+    @staticmethod
+    def _run_datasets(due_snapshots, ds_settings, snapshot_results, is_connected, this_time, now, remote_snapshots_map):
+        """
+        Runs each due dataset, in parallel if so configured
+        """
+        parallel_datasets = int(get_numeric_setting('parallel_datasets', float))
+        if parallel_datasets <= 1:
+            for dataset, local_snapshots in due_snapshots.items():
+                Manager._run_dataset(dataset, local_snapshots, ds_settings[dataset], snapshot_results.get(dataset, PROC_FAILURE),
+                        is_connected, this_time, now, remote_snapshots_map)
+            return
+
+        # Datasets replicating to the same host, through replicate or replicate2, are
+        # done in order in one task, so that a host is not hit by concurrent receives
+        # whatever endpoint command is used. Datasets sharing any host are joined
+        # into the one group, union-find style.
+        group_parent = {}
+
+        def find_group(key):
+            while group_parent[key] != key:
+                group_parent[key] = group_parent[group_parent[key]]
+                key = group_parent[key]
+            return key
+
+        for dataset in due_snapshots:
+            dataset_settings = ds_settings[dataset]
+            replicate_settings = dataset_settings['replicate']
+            push = replicate_settings['target'] is not None if replicate_settings else True
+            all_replicate_settings = (replicate_settings, dataset_settings['replicate2']) if push else (replicate_settings,)
+            group_parent.setdefault(dataset, dataset)
+            for replicate_settings in all_replicate_settings:
+                if not replicate_settings:
+                    continue
+                host = (replicate_settings['endpoint_host'], replicate_settings['endpoint_port'])
+                group_parent.setdefault(host, host)
+                group_parent[find_group(host)] = find_group(dataset)
+        dataset_groups = OrderedDict()
+        for dataset in due_snapshots:
+            dataset_groups.setdefault(find_group(dataset), []).append(dataset)
+
+        def run_group(group_datasets):
+            for dataset in group_datasets:
+                Manager._run_dataset(dataset, due_snapshots[dataset], ds_settings[dataset], snapshot_results.get(dataset, PROC_FAILURE),
+                        is_connected, this_time, now, remote_snapshots_map)
+
+        with ThreadPoolExecutor(max_workers=parallel_datasets) as executor:
+            futures = [executor.submit(run_group, group_datasets) for group_datasets in dataset_groups.values()]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as ex:
+                log_error('Exception: {0}'.format(str(ex)))
+
+    @staticmethod
+    def _run_exec(dataset, dataset_settings, exec_name):
+        try:
+            if dataset_settings[exec_name] is not None:
+                Helper.run_command(dataset_settings[exec_name], '/', log_command=dataset_settings['log_commands'])
+        except (RuntimeError, OSError) as ex:
+            log_error('[{0}] - Exception: {1}'.format(dataset, str(ex)))
+            return False
+        return True
+
+    @staticmethod
+    def run_execs(datasets, ds_settings, exec_name):
+        """
+        Runs the pre or post exection commands, side by side if parallel_datasets allows
+        """
+        parallel_datasets = int(get_numeric_setting('parallel_datasets', float))
+        if parallel_datasets <= 1 or len(datasets) <= 1:
+            return [Manager._run_exec(dataset, ds_settings[dataset], exec_name) for dataset in datasets]
+        with ThreadPoolExecutor(max_workers=parallel_datasets) as executor:
+            return list(executor.map(lambda dataset: Manager._run_exec(dataset, ds_settings[dataset], exec_name), datasets))
+
+    @staticmethod
+    def run(ds_settings, sleep_time, now=None):
+        """
+        Executes a single run where certain datasets might or might not be snapshotted
+        """
 
+        # Retest endpoints every couple of runs, so outages are noticed
+        is_connected = Manager._is_connected
+        is_connected.expire(2 * sleep_time)
+        datasets = ZFS.get_datasets()
+        # Local snapshots are taken together, so they share the one time
+        now = int(time.time()) if now is None else now
+        now_tm = time.localtime(now)
+        this_time = time.strftime(SNAPSHOTNAME_FMTSPEC, now_tm)
+        # Day rollover is checked against the one midnight for all datasets
+        midnight_epoch = MeterTime.midnight_date(now_tm)
+
+        # Work out which datasets are due to be processed this run
+        due_datasets = []
+        # Only walk the datasets that are configured, in zfs order
+        active_datasets = [ds for ds in datasets if ds in ds_settings]
+        for dataset in active_datasets:
             try:
                 dataset_settings = ds_settings[dataset]
                 take_snapshot = dataset_settings['snapshot'] is True
@@ -354,128 +737,78 @@ class Manager(object):
                 if not take_snapshot and not replicate and not replicate2 and not clean:
                     continue
 
-                replicate_settings = dataset_settings['replicate']
-                replicate2_settings = dataset_settings['replicate2']
-                full_clone = replicate_settings['full_clone'] if replicate else False
-                full_clone2 = replicate2_settings['full_clone'] if replicate2 else False
-                log_command = dataset_settings['log_commands']
-                local_snapshots = snapshots.get(dataset, OrderedDict())
-                # Manage what snapshots we operate on - everything or zsnapd only
-                if (not dataset_settings['all_snapshots'] and not full_clone):
-                    for snapshot in local_snapshots:
-                        snapshotname = local_snapshots[snapshot]['name']
-                        if (re.match(SNAPSHOTNAME_REGEX, snapshotname)):
-                            continue
-                        local_snapshots.pop(snapshot)
-
                 meter_time = dataset_settings['time']
-                if not meter_time.do_run(now):
+                if not meter_time.do_run(now, midnight_epoch):
                     continue
 
-                push = replicate_settings['target'] is not None if replicate else True
-                if push:
-                    # Pre exectution command
-                    if dataset_settings['preexec'] is not None:
-                        Helper.run_command(dataset_settings['preexec'], '/', log_command=log_command)
+                # Pulled datasets have nothing to do if the endpoint is down, so check
+                # connectivity before anything else. Pushed datasets are still
+                # snapshotted and cleaned locally, and check before replicating.
+                replicate_settings = dataset_settings['replicate']
+                if (replicate and replicate_settings['target'] is None
+                        and is_connected.test_unconnected(replicate_settings, local_dataset=dataset)):
+                    log_warn("[{0}] - Skipping as '{1}:{2}' unreachable"
+                            .format(dataset, replicate_settings['endpoint_host'], replicate_settings['endpoint_port']))
+                    continue
+                due_datasets.append(dataset)
 
-                    result = PROC_FAILURE
-                    if (take_snapshot is True and this_time not in local_snapshots):
-                        result = Manager.snapshot(dataset, local_snapshots, now, log_command=log_command)
-                    # Clean snapshots if one has been taken - clean will not execute
-                    # if no snapshot taken
-                    Cleaner.clean(dataset, local_snapshots, dataset_settings['schema'], log_command=log_command,
-                            all_snapshots=dataset_settings['clean_all'])
-                    # Execute postexec command
-                    if result and dataset_settings['postexec'] is not None:
-                            Helper.run_command(dataset_settings['postexec'], '/', log_command=log_command)
-
-                    # Replicating, if required
-                    result = PROC_FAILURE
-                    result2 = PROC_FAILURE
-                    if (replicate is True):
-                        # If network replicating, check connectivity here
-                        test_unconnected = is_connected.test_unconnected(replicate_settings, local_dataset=dataset)
-                        if test_unconnected:
-                            log_info("[{0}] - Skipping as '{1}:{2}' unreachable"
-                                    .format(dataset, replicate_settings['endpoint_host'], replicate_settings['endpoint_port']))
-                            continue
+            except (RuntimeError, OSError) as ex:
+                log_error('[{0}] - Exception: {1}'.format(dataset, str(ex)))
 
-                        remote_dataset = replicate_settings['target']
-                        remote_snapshots = ZFS.get_snapshots2(remote_dataset, replicate_settings['endpoint'], log_command=log_command,
-                                all_snapshots=dataset_settings['all_snapshots'])
-                        result = Manager.replicate(dataset, local_snapshots, remote_dataset, remote_snapshots, replicate_settings)
-                        # Clean snapshots remotely if one has been taken - only kept snapshots will allow aging
-                        if (dataset_settings['remote_schema']):
-                            Cleaner.clean(remote_dataset, remote_snapshots, dataset_settings['remote_schema'], log_command=log_command,
-                                    all_snapshots=dataset_settings['remote_clean_all'])
-                    if (replicate2 is True):
-                        # If network replicating, check connectivity here
-                        test_unconnected = is_connected.test_unconnected(replicate2_settings, local_dataset=dataset)
-                        if test_unconnected:
-                            log_info("[{0}] - Skipping as '{1}:{2}' unreachable"
-                                    .format(dataset, replicate2_settings['endpoint_host'], replicate2_settings['endpoint_port']))
-                            continue
+        if not due_datasets:
+            # Nothing to do, so no need to list all the snapshots
+            return
 
-                        remote_dataset = replicate2_settings['target']
-                        remote_snapshots = ZFS.get_snapshots2(remote_dataset, replicate2_settings['endpoint'], log_command=log_command,
-                                all_snapshots=dataset_settings['all_snapshots'])
-                        result2 = Manager.replicate(dataset, local_snapshots, remote_dataset, remote_snapshots, replicate2_settings)
-                        # Clean snapshots remotely if one has been taken - only kept snapshots will allow aging
-                        if (dataset_settings['remote2_schema']):
-                            Cleaner.clean(remote_dataset, remote_snapshots, dataset_settings['remote2_schema'], log_command=log_command,
-                                    all_snapshots=dataset_settings['remote2_clean_all'])
-                    # Post execution command
-                    if ((result or result2) and dataset_settings['replicate_postexec'] is not None):
-                        Helper.run_command(dataset_settings['replicate_postexec'], '/', log_command=log_command)
-                else:
-                    # Pull logic for remote site
-                    # Replicating, if required
-                    # If network replicating, check connectivity here
-                    test_unconnected = is_connected.test_unconnected(replicate_settings, local_dataset=dataset)
-                    if test_unconnected:
-                        log_warn("[{$0}] - Skipping as '{1}:{2}' unreachable"
-                                .format(dataset, replicate_settings['endpoint_host'], replicate_settings['endpoint_port']))
-                        continue
-                    
-                    remote_dataset = replicate_settings['target'] if push else replicate_settings['source']
-                    remote_datasets = ZFS.get_datasets(replicate_settings['endpoint'], remote_dataset, log_command=log_command)
-                    if remote_dataset not in remote_datasets:
-                        log_error("[{0}] - remote dataset '{1}' does not exist".format(dataset, remote_dataset))
-                        continue
-                    remote_snapshots = ZFS.get_snapshots2(remote_dataset, replicate_settings['endpoint'], log_command=log_command,
-                            all_snapshots=dataset_settings['all_snapshots'])
-                    endpoint = replicate_settings['endpoint']
-                    if (take_snapshot is True and this_time not in remote_snapshots):
-                        # Only execute everything here if needed
-
-                        # Remote Pre exectution command
-                        if dataset_settings['preexec'] is not None:
-                            Helper.run_command(dataset_settings['preexec'], '/', endpoint=endpoint, log_command=log_command)
-
-                        # Take remote snapshot
-                        result = PROC_FAILURE
-                        result = Manager.snapshot(remote_dataset, remote_snapshots, now, endpoint=endpoint, local_dataset=dataset, log_command=log_command)
-                        # Clean remote snapshots if one has been taken - only kept snapshots will aging to happen
-                        Cleaner.clean(remote_dataset, remote_snapshots, dataset_settings['schema'], log_command=log_command,
-                                endpoint=endpoint, local_dataset=dataset, all_snapshots=dataset_settings['clean_all'])
-                        # Execute remote postexec command
-                        if result and dataset_settings['postexec'] is not None:
-                                Helper.run_command(dataset_settings['postexec'], '/', endpoint=endpoint, log_command=log_command)
-
-                    if (replicate is True):
-                        result = PROC_FAILURE
-                        result = Manager.replicate(remote_dataset, remote_snapshots, dataset, local_snapshots, replicate_settings)
-                        # Clean snapshots locally if one has been taken - only kept snapshots will allow aging
-                        #if not replicate_settings['full_clone']:
-                        Cleaner.clean(dataset, local_snapshots, dataset_settings['local_schema'], log_command=log_command,
-                                all_snapshots=dataset_settings['local_clean_all'])
-                        # Post execution command
-                        if (result and dataset_settings['replicate_postexec'] is not None):
-                            Helper.run_command(dataset_settings['replicate_postexec'], '/', endpoint=endpoint, log_command=log_command)
+        snapshots = Manager.get_snapshots()
+        due_snapshots = OrderedDict()
+        for dataset in due_datasets:
+            try:
+                dataset_settings = ds_settings[dataset]
+                replicate_settings = dataset_settings['replicate']
+                full_clone = replicate_settings['full_clone'] if replicate_settings else False
+                # Kept in snapshots, so the map stays current as snapshots are taken
+                local_snapshots = snapshots.setdefault(dataset, OrderedDict())
+                # Manage what snapshots we operate on - everything or zsnapd only
+                if (not dataset_settings['all_snapshots'] and not full_clone):
+                    local_snapshots = OrderedDict((snapshot, value) for snapshot, value in local_snapshots.items()
+                            if SNAPSHOTNAME_RE.match(value['name']))
+                    snapshots[dataset] = local_snapshots
+                due_snapshots[dataset] = local_snapshots
 
-            except Exception as ex:
+            except (RuntimeError, OSError) as ex:
                 log_error('[{0}] - Exception: {1}'.format(dataset, str(ex)))
 
-        # Clean up
-        del is_connected
+        # Run pre exection commands, then take the local snapshots in one go
+        push_datasets = []
+        for dataset in due_snapshots:
+            replicate_settings = ds_settings[dataset]['replicate']
+            push = replicate_settings['target'] is not None if replicate_settings else True
+            if push:
+                push_datasets.append(dataset)
+        preexec_results = Manager.run_execs(push_datasets, ds_settings, 'preexec')
+        snapshot_datasets = []
+        log_command = False
+        for dataset, success in zip(push_datasets, preexec_results):
+            dataset_settings = ds_settings[dataset]
+            if not success:
+                del due_snapshots[dataset]
+                continue
+            if (dataset_settings['snapshot'] is True and this_time not in due_snapshots[dataset]):
+                snapshot_datasets.append(dataset)
+                log_command = log_command or dataset_settings['log_commands']
+        snapshot_results = Manager.snapshot_datasets(snapshot_datasets, due_snapshots, now, this_time, log_command=log_command)
+        # Post execution commands follow straight on, so that nothing the pre execution
+        # commands set up is held open while other datasets are cleaned and replicated
+        Manager.run_execs([dataset for dataset in snapshot_datasets if snapshot_results.get(dataset, PROC_FAILURE)],
+                ds_settings, 'postexec')
+
+        # Share one ssh connection per endpoint for the rest of the run
+        ssh_endpoints = Manager.start_ssh_masters(due_snapshots, ds_settings, is_connected)
+        try:
+            remote_snapshots_map = Manager.get_remote_snapshots(due_snapshots, ds_settings, is_connected)
+            Manager._run_datasets(due_snapshots, ds_settings, snapshot_results, is_connected, this_time, now,
+                    remote_snapshots_map)
+        finally:
+            for endpoint in ssh_endpoints:
+                Helper.stop_ssh_master(endpoint)
 
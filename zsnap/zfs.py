@@ -26,6 +26,7 @@ Provides basic ZFS functionality
 import time
 import re
 from collections import OrderedDict
+from functools import lru_cache
 
 from magcode.core.globals_ import log_debug
 from magcode.core.globals_ import log_info
@@ -37,12 +38,22 @@ from zsnap.globals_ import SNAPSHOTNAME_FMTSPEC
 from zsnap.globals_ import DEFAULT_BUFFER_SIZE
 from zsnap.helper import Helper
 
+SNAPSHOTNAME_RE = re.compile(SNAPSHOTNAME_REGEX)
 
 class ZFS(object):
     """
     Contains generic ZFS functionality
     """
 
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def snapshot_key(creation):
+        """
+        Formats a snapshot creation time as the key it is kept under. Snapshots
+        taken together share a creation time, so these are cached
+        """
+        return time.strftime(SNAPSHOTNAME_FMTSPEC, time.localtime(creation))
+
     @staticmethod
     def get_snapshots(dataset='', endpoint='', all_snapshots=True, log_command=False):
         """
@@ -53,21 +64,20 @@ class ZFS(object):
             command = 'zfs list -pH -s creation -o name,creation -t snapshot{0}{1} || true'
         else:
             command = '{0} \'zfs list -pH -s creation -o name,creation -t snapshot{1} || true\''
-        if dataset == '':
-            dataset_filter = ''
-        else:
-            dataset_filter = ' | grep ^{0}@'.format(dataset)
-        output = Helper.run_command(command.format(endpoint, dataset_filter), '/', log_command=log_command)
+        # Naming the dataset lists just its snapshots, rather than the whole pool
+        dataset_arg = ' {0}'.format(dataset) if dataset else ''
+        lines = Helper.run_command_iter(command.format(endpoint, dataset_arg), '/', log_command=log_command)
         snapshots = {}
-        for line in filter(len, output.split('\n')):
-            parts = list(filter(len, line.split('\t')))
-            datasetname = parts[0].split('@')[0]
-            creation = int(parts[1])
-            snapshot = time.strftime(SNAPSHOTNAME_FMTSPEC, time.localtime(creation))
-            snapshotname = parts[0].split('@')[1]
-            if (not all_snapshots and re.match(SNAPSHOTNAME_REGEX, snapshotname) is None):
+        for line in lines:
+            if not line:
+                continue
+            parts = line.split('\t')
+            datasetname, _, snapshotname = parts[0].partition('@')
+            if (not all_snapshots and SNAPSHOTNAME_RE.match(snapshotname) is None):
                 # If required, only read in zsnapd snapshots
                 continue
+            creation = int(parts[1])
+            snapshot = ZFS.snapshot_key(creation)
             if datasetname not in snapshots:
                 snapshots[datasetname] = OrderedDict()
             snapshots[datasetname].update({snapshot:{'name': snapshotname, 'creation': creation}})
@@ -81,19 +91,46 @@ class ZFS(object):
         command = 'zfs list -pH -s creation -o name,creation -t snapshot {1} || true'
         if endpoint:
             command = '{0} \'' + command + '\''
-        output = Helper.run_command(command.format(endpoint, dataset), '/', log_command=log_command)
+        lines = Helper.run_command_iter(command.format(endpoint, dataset), '/', log_command=log_command)
         snapshots = OrderedDict()
-        for line in filter(len, output.split('\n')):
-            parts = list(filter(len, line.split('\t')))
-            creation = int(parts[1])
-            snapshot = time.strftime(SNAPSHOTNAME_FMTSPEC, time.localtime(creation))
-            snapshotname = parts[0].split('@')[1]
-            if (not all_snapshots and re.match(SNAPSHOTNAME_REGEX, snapshotname) is None):
+        for line in lines:
+            if not line:
+                continue
+            parts = line.split('\t')
+            snapshotname = parts[0].partition('@')[2]
+            if (not all_snapshots and SNAPSHOTNAME_RE.match(snapshotname) is None):
                 # If required, only read in zsnapd snapshots
                 continue
+            creation = int(parts[1])
+            snapshot = ZFS.snapshot_key(creation)
             snapshots[snapshot] = {'name': snapshotname, 'creation': creation}
         return snapshots
 
+    @staticmethod
+    def get_snapshots_many(datasets, endpoint='', all_snapshots=True, log_command=False):
+        """
+        Retreives the snapshots of a list of datasets with one zfs list
+        """
+        command = 'zfs list -pH -s creation -o name,creation -t snapshot {1} || true'
+        if endpoint:
+            command = '{0} \'' + command + '\''
+        lines = Helper.run_command_iter(command.format(endpoint, ' '.join(datasets)), '/', log_command=log_command)
+        snapshots = OrderedDict([(dataset, OrderedDict()) for dataset in datasets])
+        for line in lines:
+            if not line:
+                continue
+            parts = line.split('\t')
+            datasetname, _, snapshotname = parts[0].partition('@')
+            if (not all_snapshots and SNAPSHOTNAME_RE.match(snapshotname) is None):
+                # If required, only read in zsnapd snapshots
+                continue
+            creation = int(parts[1])
+            snapshot = ZFS.snapshot_key(creation)
+            if datasetname not in snapshots:
+                continue
+            snapshots[datasetname][snapshot] = {'name': snapshotname, 'creation': creation}
+        return snapshots
+
     @staticmethod
     def get_datasets(endpoint='', dataset='', log_command=False):
         """
@@ -106,8 +143,10 @@ class ZFS(object):
             command = '{0} \'' + command + '\''
         output = Helper.run_command(command.format(endpoint, dataset), '/', log_command=log_command)
         datasets = {}
-        for line in filter(len, output.split('\n')):
-            parts = list(filter(len, line.split('\t')))
+        for line in output.splitlines():
+            if not line:
+                continue
+            parts = line.split('\t')
             datasets[parts[0]] = {'name': parts[0], 'mountpoint': parts[1]}
         return datasets
 
@@ -122,6 +161,15 @@ class ZFS(object):
             command = "{0} 'zfs snapshot {1}@{2}'".format(endpoint, dataset, name)
         Helper.run_command(command, '/', log_command=log_command)
 
+    @staticmethod
+    def snapshot_many(datasets, name, log_command=False):
+        """
+        Takes a snapshot of several local datasets in one atomic operation.
+        The datasets must all be in the same pool.
+        """
+        command = 'zfs snapshot {0}'.format(' '.join('{0}@{1}'.format(dataset, name) for dataset in datasets))
+        Helper.run_command(command, '/', log_command=log_command)
+
     @staticmethod
     def abort_interrupted_receive(dataset, endpoint='', log_command=False, no_save=False):
         """
@@ -149,6 +197,46 @@ class ZFS(object):
             receive_resume_token = line
         return receive_resume_token if receive_resume_token != '-' else ''
 
+    @staticmethod
+    def get_written(dataset, base_snapshot, last_snapshot, endpoint='', log_command=False):
+        """
+        Retreives the space written between two snapshots, None if unknown
+        """
+        if endpoint == '':
+            command = 'zfs get written@{1} -pHo value {0}@{2}'.format(dataset, base_snapshot, last_snapshot)
+        else:
+            command = "{0} 'zfs get written@{2} -pHo value {1}@{3}'".format(endpoint, dataset, base_snapshot, last_snapshot)
+        try:
+            output = Helper.run_command(command, '/', log_command=log_command)
+        except RuntimeError as ex:
+            # Older zfs, or a remote zsnapd-rcmd.conf without rcmd_zfs_get_written,
+            # just means falling back to the dry-run send estimate
+            log_debug('written@ probe failed, using zfs send -nv: {0}'.format(str(ex)))
+            return None
+        written = output.strip()
+        return int(written) if written.isdigit() else None
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def send_args(send_compression, send_raw, send_properties, full_clone, resuming):
+        """
+        Works out the zfs send flags shared by replicate and get_size
+        """
+        send_args = ''
+        if send_compression:
+            send_args += 'Lec'
+        if send_raw:
+            send_args += 'w'
+        if not resuming:
+            if send_properties:
+                send_args += 'p'
+            if full_clone:
+                send_args += 'R'
+        if send_args:
+            send_args = '-' + send_args
+            send_args += ' '
+        return send_args
+
     @staticmethod
     def replicate(dataset, base_snapshot, last_snapshot, target, endpoint='', receive_resume_token='', direction='push',
             buffer_size=DEFAULT_BUFFER_SIZE, compression=None, receive_mountpoint='',
@@ -166,19 +254,8 @@ class ZFS(object):
             else:
                 delta = '-I {0}@{1} '.format(dataset, base_snapshot)
 
-        send_args = ''
-        if send_compression:
-            send_args += 'Lec'
-        if send_raw:
-            send_args += 'w'
-        if not receive_resume_token:
-            if send_properties:
-                send_args += 'p'
-            if full_clone:
-                send_args += 'R'
-        if send_args:
-            send_args = '-' + send_args
-            send_args += ' '
+        send_args = ZFS.send_args(send_compression, send_raw, send_properties, full_clone,
+                bool(receive_resume_token))
 
         receive_args = ''
         if receive_save:
@@ -235,11 +312,13 @@ class ZFS(object):
         command = command.format(endpoint, target)
         output = Helper.run_command(command, '/', log_command=log_command)
         holds = []
-        for line in filter(len, output.split('\n')):
-            parts = list(filter(len, line.split('\t')))
+        for line in output.splitlines():
+            if not line:
+                continue
+            parts = line.split('\t')
             if parts[1] != 'zsm':
                 continue
-            snapshotname = parts[0].split('@')[1]
+            snapshotname = parts[0].partition('@')[2]
             holds.append(snapshotname)
         holds.sort()
         return holds
@@ -271,6 +350,18 @@ class ZFS(object):
             command = '{0} \'zfs release zsm {1}@{2} || true\''.format(endpoint, target, snapshot)
             Helper.run_command(command, '/', log_command=log_command)
 
+    @staticmethod
+    def release_many(target, snapshots, endpoint='', log_command=False):
+        """
+        Releases the hold on a list of snapshots of a dataset in one command
+        """
+        snapshot_names = ' '.join(['{0}@{1}'.format(target, snapshot) for snapshot in snapshots])
+        if endpoint == '':
+            command = 'zfs release zsm {0} || true'.format(snapshot_names)
+        else:
+            command = '{0} \'zfs release zsm {1} || true\''.format(endpoint, snapshot_names)
+        Helper.run_command(command, '/', log_command=log_command)
+
     @staticmethod
     def get_size(dataset, base_snapshot, last_snapshot, endpoint='', receive_resume_token='',
             buffer_size=DEFAULT_BUFFER_SIZE, compression=None, receive_mountpoint='',
@@ -281,6 +372,12 @@ class ZFS(object):
         """
         Executes a dry-run zfs send to calculate the size of the delta.
         """
+        if (base_snapshot is not None and not receive_resume_token and not full_clone):
+            # Reading written@ is far cheaper than a dry-run send walking the blocks
+            written = ZFS.get_written(dataset, base_snapshot, last_snapshot, endpoint=endpoint, log_command=log_command)
+            if written == 0:
+                return '0B'
+
         delta = ''
         if base_snapshot is not None:
             if (not full_clone and not all_snapshots):
@@ -288,19 +385,8 @@ class ZFS(object):
             else:
                 delta = '-I {0}@{1} '.format(dataset, base_snapshot)
 
-        send_args = ''
-        if send_compression:
-            send_args += 'Lec'
-        if send_raw:
-            send_args += 'w'
-        if not receive_resume_token:
-            if send_properties:
-                send_args += 'p'
-            if full_clone:
-                send_args += 'R'
-        if send_args:
-            send_args = '-' + send_args
-            send_args += ' '
+        send_args = ZFS.send_args(send_compression, send_raw, send_properties, full_clone,
+                bool(receive_resume_token))
 
         # Work out zfs send command
         if receive_resume_token:
@@ -313,9 +399,13 @@ class ZFS(object):
         else:
             command = '{4} \'' + zfs_send_cmd + '\''
         command = command.format(send_args, delta, dataset, last_snapshot, endpoint)
-        command = '{0} 2>&1 | grep \'estimated size is\''.format(command)
+        command = '{0} 2>&1'.format(command)
         output = Helper.run_command(command, '/', log_command=log_command)
-        size = output.strip().split(' ')[-1]
+        # The last estimate is the total when several snapshots are sent
+        _, found, after = output.rpartition('estimated size is ')
+        if not found:
+            raise RuntimeError('{0} gave no size estimate: {1}'.format(command, output.strip()))
+        size = after.split('\n', 1)[0].strip().split(' ')[-1]
         if size[-1].isdigit():
             return '{0}B'.format(size)
         return '{0}iB'.format(size)
@@ -330,3 +420,14 @@ class ZFS(object):
         else:
             command = "{0} 'zfs destroy {1}@{2}'".format(endpoint, dataset, snapshot)
         Helper.run_command(command, '/', log_command=log_command)
+
+    @staticmethod
+    def destroy_many(dataset, snapshots, endpoint='', log_command=False):
+        """
+        Destroyes a list of snapshots of a dataset in one operation
+        """
+        if endpoint == '':
+            command = 'zfs destroy {0}@{1}'.format(dataset, ','.join(snapshots))
+        else:
+            command = "{0} 'zfs destroy {1}@{2}'".format(endpoint, dataset, ','.join(snapshots))
+        Helper.run_command(command, '/', log_command=log_command)
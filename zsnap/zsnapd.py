@@ -95,6 +95,13 @@ class ZsnapdProcess(ProcessDaemon):
         debug_sleep_time = int(get_numeric_setting('debug_sleep_time', float))
         sleep_time = debug_sleep_time if debug() else sleep_time
 
+        # Directory for shared ssh connection sockets
+        if get_boolean_setting('ssh_control_master'):
+            try:
+                os.makedirs(settings['ssh_control_dir'], mode=0o700, exist_ok=True)
+            except OSError as exc:
+                log_error("Can't create ssh control directory '{0}' - {1}".format(settings['ssh_control_dir'], str(exc)))
+
         # Initialise Manager stuff
         ds_settings = Config.read_ds_config()
 
@@ -102,7 +109,7 @@ class ZsnapdProcess(ProcessDaemon):
         while (self.check_signals()):
             
             try:
-                Manager.run(ds_settings, sleep_time)
+                Manager.run(ds_settings, sleep_time, now=int(time.time()))
             except Exception as ex:
                 log_error('Exception: {0}'.format(str(ex)))
             
@@ -33,7 +33,6 @@ from magcode.core.process import Process
 from magcode.core.globals_ import *
 # import this to set up config file settings etc
 import zsnap.globals_
-from zsnap.manager import Manager
 from zsnap.config import Config
 
 USAGE_MESSAGE = "Usage: %s [-hv] [-c config_file]"
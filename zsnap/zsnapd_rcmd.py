@@ -113,6 +113,15 @@ class ZsnapdRCmdProcess(Process):
         setup_file_logging()
         remove_daemon_stderr_logging()
 
+        # Without a command there is nothing to check the regexes against
+        try:
+            orig_cmd = os.environ["SSH_ORIGINAL_COMMAND"]
+            log_debug("SSH_ORIGINAL_COMMAND is: '{0}'".format(orig_cmd))
+        except KeyError:
+            log_error('SSH_ORIGINAL_COMMAND - environment variable not found.')
+            print('SECURITY - command rejected', file=sys.stderr)
+            sys.exit(os.EX_NOPERM)
+
         # Load configuration
         rshell = settings['rshell']
         allowed_cmd_regex_dict = {
@@ -128,6 +137,7 @@ class ZsnapdRCmdProcess(Process):
                 'rcmd_zfs_release': settings['rcmd_zfs_release'],
                 'rcmd_zfs_get_size': settings['rcmd_zfs_get_size'],
                 'rcmd_zfs_get_size2': settings['rcmd_zfs_get_size2'],
+                'rcmd_zfs_get_written': settings['rcmd_zfs_get_written'],
                 'rcmd_zfs_destroy': settings['rcmd_zfs_destroy'],
                 'rcmd_zfs_recieve_abort': settings['rcmd_zfs_receive_abort'],
                 'rcmd_zfs_get_receive_resume_token': settings['rcmd_zfs_get_receive_resume_token'],
@@ -167,13 +177,6 @@ class ZsnapdRCmdProcess(Process):
             sys.exit(os.EX_NOPERM)
 
         # Process command
-        try:
-            orig_cmd = os.environ["SSH_ORIGINAL_COMMAND"]
-            log_debug("SSH_ORIGINAL_COMMAND is: '{0}'".format(orig_cmd))
-        except KeyError:
-            log_error('SSH_ORIGINAL_COMMAND - environment variable not found.')
-            print('SECURITY - command rejected', file=sys.stderr)
-            sys.exit(os.EX_NOPERM)
         allowed = False
         for regex in allowed_cmd_regex_dict.values():
             if not regex: